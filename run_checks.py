@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-code = 0
-for cmd in [
+# static checks are independent so they run concurrently (output is buffered
+# to not interleave), tests run afterwards with their output streamed
+static_cmds = [
     "pylint snowflake_stage_exporter tests",
     "mypy snowflake_stage_exporter tests",
     "black snowflake_stage_exporter tests --check",
     "isort snowflake_stage_exporter tests --check",
-    "pytest tests",
-]:
-    print(">" * 10 + f" CHECK: {cmd}")
-    try:
-        subprocess.run(cmd.split(), check=True)
-    except subprocess.CalledProcessError:
-        print("x" * 10 + f" FAIL: {cmd}")
-        code = 1
+]
+test_cmd = "pytest tests"
+
+
+def run_captured(command):
+    return subprocess.run(
+        command.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False
+    )
+
+
+code = 0
+with ThreadPoolExecutor(max_workers=len(static_cmds)) as executor:
+    for cmd, result in zip(static_cmds, executor.map(run_captured, static_cmds)):
+        print(">" * 10 + f" CHECK: {cmd}")
+        print(result.stdout.decode(), end="", flush=True)
+        if result.returncode:
+            print("x" * 10 + f" FAIL: {cmd}")
+            code = 1
+
+print(">" * 10 + f" CHECK: {test_cmd}", flush=True)
+if subprocess.run(test_cmd.split(), check=False).returncode:
+    print("x" * 10 + f" FAIL: {test_cmd}")
+    code = 1
 sys.exit(code)
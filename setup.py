@@ -8,6 +8,10 @@ setup(
     python_requires=">=3.6",
     install_requires=[
         "itemadapter",
+        "orjson",
         "snowflake-connector-python",
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
 )
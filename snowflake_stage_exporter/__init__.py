@@ -1,27 +1,99 @@
+import gzip
 import json
 import logging
-import os
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AbstractContextManager
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Any, Collection, Dict, Iterable, Literal, Set
-
+from functools import partial
+from string import Formatter
+from tempfile import NamedTemporaryFile
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import orjson
 import snowflake.connector  # type: ignore
 from itemadapter import ItemAdapter  # type: ignore
 
-from .utils import chunk, normalize_identifier
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
+
+from .utils import (
+    _field_root,
+    chunk,
+    escape_regex,
+    normalize_identifier,
+    quote_string,
+    template_field_names,
+    template_fields,
+    template_item_keys,
+)
 
 logger = logging.getLogger(__name__)
 
 
 ExporterEvent = Literal["finish", "flush", "never"]
+Compression = Literal["gzip", "zstd"]
+
+_FORMATTER = Formatter()
+
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+# (sql, callback to run once the statement succeeded)
+_Statement = Tuple[str, Callable[[], None]]
 
 
 class SnowflakeStageExporterError(Exception):
     pass
 
 
+def _item_to_dict(item: Any) -> Dict:
+    if type(item) is dict and _SCALAR_TYPES.issuperset(map(type, item.values())):
+        # nothing for ItemAdapter to convert in a flat dict of scalars
+        return item
+    return ItemAdapter(item).asdict()
+
+
+class _ZstdFile:
+    """Write only zstd counterpart of `gzip.GzipFile` used for table buffers,
+    `tell()` returns the uncompressed size just like `GzipFile.tell()` does.
+    """
+
+    def __init__(self, fileobj, level: int):
+        self.fileobj = fileobj
+        self._writer = zstandard.ZstdCompressor(level=level).stream_writer(
+            fileobj, closefd=False
+        )
+        self._size = 0
+
+    def write(self, data) -> int:
+        self._writer.write(data)
+        self._size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._size
+
+    def flush(self) -> None:
+        self._writer.flush()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
 class SnowflakeStageExporter(AbstractContextManager):
 
     typemap = {
@@ -33,6 +105,14 @@ class SnowflakeStageExporter(AbstractContextManager):
         str: "VARCHAR",
     }
     multitype = "VARIANT"
+    json_options = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+    write_chunk_size = 64 * 2 ** 10
+    compresslevel = 1
+    file_buffer_size = 2 ** 20
+    max_files_per_copy = 1000  # Snowflake limit for FILES in COPY INTO
+    max_files_per_remove = 1000
+    max_recorded_signatures = 1000  # per table
+    max_cached_table_paths = 10000
 
     def __init__(
         self,
@@ -50,6 +130,9 @@ class SnowflakeStageExporter(AbstractContextManager):
         create_tables_on: ExporterEvent = "finish",
         populate_tables_on: ExporterEvent = "finish",
         clear_stage_on: ExporterEvent = "never",
+        max_upload_workers: int = 4,
+        compression: Compression = "gzip",
+        tmp_dir: Optional[str] = None,
     ):
         self._max_file_size = max_file_size
         self._table_path = table_path
@@ -61,7 +144,21 @@ class SnowflakeStageExporter(AbstractContextManager):
         self._allow_varying_value_types = allow_varying_value_types
         self._predefined_column_types = predefined_column_types or {}
         self._ignore_unexpected_fields = ignore_unexpected_fields
+        self._max_upload_workers = max_upload_workers
+        self._compression = compression
+        self._tmp_dir = tmp_dir
         self._instance_ms = int(time.time() * 1000)
+        self._table_path_fields = template_fields(table_path)
+        # extra parameters referenced by name and the ones whose attributes / items
+        # are referenced (e.g. `{spider.name}`), only the latter need resolving
+        params_fields = [
+            f for f in template_field_names(table_path) if _field_root(f) != "item"
+        ]
+        self._table_path_params = tuple(f for f in params_fields if _field_root(f) == f)
+        self._table_path_param_accessors = tuple(
+            f for f in params_fields if _field_root(f) != f
+        )
+        self._table_path_item_keys = template_item_keys(table_path)
 
         exporter_events = typing.get_args(ExporterEvent)
         for attr in ("create_tables_on", "populate_tables_on", "clear_stage_on"):
@@ -71,6 +168,17 @@ class SnowflakeStageExporter(AbstractContextManager):
                     f"unexpected value ({val!r}) for {attr!r}, expected one of {exporter_events!r}"
                 )
 
+        compressions = typing.get_args(Compression)
+        if compression not in compressions:
+            raise ValueError(
+                f"unexpected value ({compression!r}) for 'compression', expected one of {compressions!r}"
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ImportError(
+                "'zstd' compression requires zstandard package: "
+                "pip install snowflake-stage-exporter[zstd]"
+            )
+
         if any(not v for v in self._predefined_column_types.values()):
             raise ValueError("values of 'predefined_column_types' can't be empty")
 
@@ -84,10 +192,25 @@ class SnowflakeStageExporter(AbstractContextManager):
             **(connection_kwargs or {}),
         )
         self._table_buffers: Dict = {}  # {table_path: tmp_buffer_file}
+        self._pending_writes: Dict = {}  # {table_path: bytearray}
+        self._buffer_files_pool: List = []  # [emptied_tmp_buffer_file, ...]
         self._exported_fpaths: Dict = {}  # {table_path: [exported_fpath_in_stage, ...]}
         self._recorded_coltypes: Dict = {}  # {table_path: {field: set({cls, ...})}}
+        self._recorded_signatures: Dict = {}  # {table_path: {(*fields, *types), ...}}
         self._created_tables_for: Set[str] = set()  # {table_path, ...}
         self._copied_fpaths: Set[str] = set()  # {copied_fpath_in_stage, ...}
+        self._column_types_cache: Dict = {}  # {table_path: {column: coltype}}
+        self._copy_columns_cache: Dict = {}  # {table_path: (coltypes, cols, select)}
+        self._table_path_cache: Dict = {}  # {(extra_param_value, ...): table_path}
+        self._normalized_table_paths: Dict = {}  # {expanded_table_path: table_path}
+        # [staged_fpath, ...] to remove at once, only set while flushing all buffers
+        self._deferred_removals: Optional[List[str]] = None
+        self._batch_counts: Dict = {}  # {table_path: detached_buffers_count}
+        self._upload_executor: Optional[ThreadPoolExecutor] = None
+        # [(table_path, tmp_file, fpath, future_fpath_in_stage), ...]
+        self._background_uploads: List = []
+        # [(table_path, tmp_file, fpath), ...] to retry on next flush of all buffers
+        self._failed_uploads: List = []
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
@@ -96,88 +219,351 @@ class SnowflakeStageExporter(AbstractContextManager):
         return snowflake.connector.connect(**connection_kwargs)
 
     def close(self) -> None:
+        if self._upload_executor is not None:
+            self._upload_executor.shutdown()
+        self._collect_background_uploads(raise_errors=False)
+        if self._failed_uploads:
+            logger.error(
+                "Closing with %d buffer(s) that failed to upload: %r",
+                len(self._failed_uploads),
+                [fpath for _, _, fpath in self._failed_uploads],
+            )
+        while self._failed_uploads:
+            self._failed_uploads.pop()[1].close()
+        while self._buffer_files_pool:
+            self._buffer_files_pool.pop().close()
         self.conn.close()
 
     def export_item(self, item: Any, **extra_params) -> str:
-        item_dict: Dict = ItemAdapter(item).asdict()
-
+        item_dict = _item_to_dict(item)
         table_path = self.table_for_item(item_dict, **extra_params)
-        if table_path not in self._table_buffers:
-            logger.info("Creating buffer for %r", table_path)
-            self._table_buffers[table_path] = NamedTemporaryFile("wb")
-
-        line = json.dumps(item_dict) + "\n"
-        self._table_buffers[table_path].write(line.encode("utf8"))
-        if self._should_flush_buffer_for(table_path):
-            self.flush_table_buffer(table_path)
+        self._buffer_item(table_path, item_dict)
+        return table_path
 
+    def export_items(self, items: Iterable[Any], **extra_params) -> None:
+        """Same as calling `export_item(item, **extra_params)` for each item.
+        When `table_path` doesn't reference `item` it's resolved once for all items.
+        """
+        if "item" in self._table_path_fields:
+            for item in items:
+                self.export_item(item, **extra_params)
+            return
+        table_path = self.table_for_item({}, **extra_params)
+        buffer_item = self._buffer_item
+        for item in items:
+            buffer_item(table_path, _item_to_dict(item))
+
+    def _buffer_item(self, table_path: str, item_dict: Dict) -> None:
+        buffer = self._table_buffers.get(table_path)
+        if buffer is None:
+            buffer = self._create_table_buffer(table_path)
+        pending = self._pending_writes[table_path]
+        pending += self.serialize_item(item_dict)
+        # the item is exported at this point, so its bookkeeping is done before
+        # anything that may fail due to other items (e.g. flushing the buffer)
         self._record_field_types(table_path, item_dict)
+        if len(pending) >= self.write_chunk_size:
+            self._write_pending(table_path)
+        if buffer.tell() + len(pending) >= self._max_file_size:
+            if self._max_upload_workers > 1:
+                if len(self._background_uploads) >= self._max_upload_workers:
+                    # don't let buffers pile up when uploading is slower than exporting
+                    self._collect_background_uploads(1, raise_errors=False)
+                self._upload_in_background(table_path)
+            else:
+                self.flush_table_buffer(table_path)
 
-        return table_path
+    def serialize_item(self, item_dict: Dict) -> bytes:
+        """Serializes item into a line of staged file, including trailing newline.
+        Staged files are loaded as JSON, so overrides must still produce JSON,
+        e.g. to support extra value types via orjson's `default`.
+        """
+        try:
+            return orjson.dumps(item_dict, option=self.json_options)
+        except orjson.JSONEncodeError:
+            # stdlib json handles some values orjson rejects, e.g. integers
+            # above 64 bits or strings with lone surrogates
+            return json.dumps(item_dict, separators=(",", ":")).encode("utf8") + b"\n"
+
+    def _create_table_buffer(self, table_path: str) -> Union[gzip.GzipFile, _ZstdFile]:
+        logger.info("Creating buffer for %r", table_path)
+        buffer: Union[gzip.GzipFile, _ZstdFile]
+        if self._compression == "zstd":
+            buffer = _ZstdFile(self._acquire_buffer_file(), self.compresslevel)
+        else:
+            buffer = gzip.GzipFile(
+                filename="",
+                mode="wb",
+                compresslevel=self.compresslevel,
+                fileobj=self._acquire_buffer_file(),
+                mtime=0,
+            )
+        self._table_buffers[table_path] = buffer
+        self._pending_writes.setdefault(table_path, bytearray())
+        return buffer
 
-    def _should_flush_buffer_for(self, table_path: str) -> bool:
-        return self._table_buffers[table_path].tell() >= self._max_file_size
+    def _write_pending(self, table_path: str) -> None:
+        """Moves accumulated lines of a table into its buffer file in a single write.
+        The bytearray itself is kept (cleared) and reused for the following lines.
+        """
+        pending = self._pending_writes[table_path]
+        self._table_buffers[table_path].write(pending)
+        pending.clear()
 
     def _record_field_types(self, table_path: str, item_dict: Dict) -> None:
         if table_path in self._created_tables_for:
             return
+        # items of a table mostly share fields and value types, so an already
+        # recorded combination of both (the item's "signature") is skipped at once
+        signature = (*item_dict, *map(type, item_dict.values()))
+        signatures = self._recorded_signatures.setdefault(table_path, set())
+        if signature in signatures:
+            return
         recorded = self._recorded_coltypes.setdefault(table_path, {})
+        typemap = self.typemap
         for k, v in item_dict.items():
-            if v is not None:
-                recorded.setdefault(k, set()).add(self.typemap[type(v)])
+            if v is None:
+                continue
+            coltype = typemap.get(type(v)) or self._subclass_coltype(type(v))
+            coltypes = recorded.get(k)
+            if coltypes is None:
+                recorded[k] = {coltype}
+            elif coltype not in coltypes:
+                coltypes.add(coltype)
+            else:
+                continue
+            self._column_types_cache.pop(table_path, None)
+        if len(signatures) < self.max_recorded_signatures:
+            signatures.add(signature)
+
+    def _subclass_coltype(self, cls: type) -> str:
+        """Column type for subclasses of `typemap` types (e.g. `IntEnum` -> NUMBER),
+        values of exact types are looked up directly as that's the common case.
+        """
+        for base in cls.__mro__:
+            if base in self.typemap:
+                return self.typemap[base]
+        raise KeyError(cls)
 
     def table_for_item(self, item_dict: Dict, **extra_params) -> str:
-        table_path = self._table_path.format(**extra_params, item=item_dict)
-        table_path = ".".join(map(normalize_identifier, table_path.split(".", 2)))
+        item_keys = self._table_path_item_keys
+        if item_keys is None:
+            return self._expand_table_path(item_dict, extra_params)
+        # table path only depends on referenced extra parameters and item values,
+        # so it's only expanded once per distinct combination of them
+        values = tuple(extra_params.get(f) for f in self._table_path_params)
+        if self._table_path_param_accessors:
+            # values are resolved as objects referenced by name may change
+            values += tuple(
+                _FORMATTER.get_field(f, (), extra_params)[0]
+                for f in self._table_path_param_accessors
+            )
+        if item_keys:
+            values += tuple(item_dict[k] for k in item_keys)
+        # types are part of the key as e.g. 1 and True are equal but formatted differently
+        cache_key = values + tuple(map(type, values))
+        try:
+            table_path = self._table_path_cache.get(cache_key)
+        except TypeError:  # unhashable parameter value
+            return self._expand_table_path(item_dict, extra_params)
+        if table_path is None:
+            table_path = self._expand_table_path(item_dict, extra_params)
+            # distinct values may outnumber tables by far (e.g. `{item[name]:.1}`),
+            # so the cache is capped, further values are expanded every time
+            if len(self._table_path_cache) < self.max_cached_table_paths:
+                self._table_path_cache[cache_key] = table_path
+        return table_path
+
+    def _expand_table_path(self, item_dict: Dict, extra_params: Dict) -> str:
+        expanded = self._table_path.format(**extra_params, item=item_dict)
+        table_path = self._normalized_table_paths.get(expanded)
+        if table_path is None:
+            table_path = ".".join(map(normalize_identifier, expanded.split(".", 2)))
+            self._normalized_table_paths[expanded] = table_path
         return table_path
 
     def fpath_for_table(self, table_path: str, batch_n: int) -> str:
-        return self._stage_path.format(
+        fpath = self._stage_path.format(
             table_path=table_path,
             instance_ms=self._instance_ms,
             batch_n=batch_n,
         )
+        return fpath + (".zst" if self._compression == "zstd" else ".gz")
 
     def flush_table_buffer(self, table_path: str) -> None:
-        # HACK: there is no straightforward way to provide a filename via PUT
-        # statement, so as a workaround we symlink our file into a temporary
-        # directory with the desired filename.
-        tmp_file = self._table_buffers[table_path]
+        tmp_file, fpath = self._detach_table_buffer(table_path)
+        self._stage_table_buffer(table_path, tmp_file, fpath)
+
+    def _stage_table_buffer(self, table_path: str, tmp_file, fpath: str) -> None:
+        try:
+            staged_fpath = self._upload_table_buffer(tmp_file, fpath)
+        except Exception:
+            self._failed_uploads.append((table_path, tmp_file, fpath))
+            raise
+        self._on_table_buffer_staged(table_path, staged_fpath)
+
+    def _detach_table_buffer(self, table_path: str) -> Tuple[Any, str]:
+        """Finalizes table buffer and returns its temporary file along with
+        the desired fpath in stage.
+        """
+        self._write_pending(table_path)
+        buffer = self._table_buffers.pop(table_path)
+        tmp_file = buffer.fileobj
+        buffer.close()
         tmp_file.flush()
-        batch_n = len(self._exported_fpaths.setdefault(table_path, [])) + 1
-        with TemporaryDirectory() as tempdir:
-            fpath = self.fpath_for_table(table_path, batch_n)
-            logger.info(
-                "Flushing buffer of %r to %r (batch %d)", table_path, fpath, batch_n
+        self._exported_fpaths.setdefault(table_path, [])
+        batch_n = self._batch_counts[table_path] = (
+            self._batch_counts.get(table_path, 0) + 1
+        )
+        fpath = self.fpath_for_table(table_path, batch_n)
+        logger.info(
+            "Flushing buffer of %r to %r (batch %d)", table_path, fpath, batch_n
+        )
+        return tmp_file, fpath
+
+    def _upload_table_buffer(self, tmp_file, fpath: str) -> str:
+        fpath = self._put_file(tmp_file, self._stage, fpath)
+        self._release_buffer_file(tmp_file)
+        return fpath
+
+    def _upload_in_background(self, table_path: str) -> None:
+        """Detaches table buffer and uploads it in a worker thread, so exporting
+        can go on meanwhile. The file is recorded as staged (and `*_on="flush"`
+        actions run) by `_collect_background_uploads()`.
+        """
+        self._submit_upload(table_path, *self._detach_table_buffer(table_path))
+
+    def _submit_upload(self, table_path: str, tmp_file, fpath: str) -> None:
+        if self._upload_executor is None:
+            self._upload_executor = ThreadPoolExecutor(
+                max_workers=self._max_upload_workers
             )
-            prefix, fname = fpath.rsplit("/", 1)
-            symlink_path = os.path.join(tempdir, fname)
-            os.symlink(tmp_file.name, symlink_path)
-            fpath = self._put_file(symlink_path, self._stage, prefix)
-        tmp_file.close()
-        self._table_buffers.pop(table_path)
+        future = self._upload_executor.submit(
+            self._upload_table_buffer, tmp_file, fpath
+        )
+        self._background_uploads.append((table_path, tmp_file, fpath, future))
+
+    def _collect_background_uploads(
+        self, count: Optional[int] = None, raise_errors: bool = True
+    ) -> None:
+        """Waits for the oldest `count` (all by default) background uploads and
+        records them in submission order. Failed uploads are kept for a retry by
+        the next flush of all buffers. With `raise_errors` the first error is raised
+        after every upload is handled, otherwise errors are only logged (used while
+        exporting, where they don't concern the item being exported).
+        """
+        uploads = self._background_uploads[:count]
+        del self._background_uploads[:count]
+        error = None
+        for table_path, tmp_file, fpath, future in uploads:
+            if future.exception() is not None:
+                self._failed_uploads.append((table_path, tmp_file, fpath))
+                error = error or future.exception()
+                if not raise_errors:
+                    logger.error(
+                        "Failed to upload %r, will retry on next flush",
+                        fpath,
+                        exc_info=future.exception(),
+                    )
+                continue
+            try:
+                self._on_table_buffer_staged(table_path, future.result())
+            except Exception as exc:  # pylint: disable=broad-except
+                if raise_errors:
+                    error = error or exc
+                    continue
+                logger.exception(
+                    "Failed to run flush actions for %r staged to %r",
+                    table_path,
+                    future.result(),
+                )
+        if raise_errors and error is not None:
+            raise error
+
+    def _acquire_buffer_file(self):
+        if self._buffer_files_pool:
+            return self._buffer_files_pool.pop()
+        return NamedTemporaryFile(
+            "w+b", buffering=self.file_buffer_size, dir=self._tmp_dir
+        )
+
+    def _release_buffer_file(self, tmp_file) -> None:
+        """Empties uploaded buffer file and keeps it for reuse by the next buffer."""
+        tmp_file.seek(0)
+        tmp_file.truncate()
+        self._buffer_files_pool.append(tmp_file)
+
+    def _on_table_buffer_staged(self, table_path: str, fpath: str) -> None:
         self._exported_fpaths[table_path].append(fpath)
 
+        statements = []
         if self._create_tables_on == "flush":
-            self.create_table(table_path)
+            statements += self._create_table_statements(table_path)
         if self._populate_tables_on == "flush":
-            self.populate_table(table_path)
+            statements += self._populate_table_statements(table_path)
+        self._execute_statements(statements)
         if self._clear_stage_on == "flush":
-            self.clear_stage([fpath])
+            if self._deferred_removals is not None:
+                self._deferred_removals.append(fpath)
+            else:
+                self.clear_stage([fpath])
+
+    @property
+    def _compression_sql(self) -> str:
+        return "ZSTD" if self._compression == "zstd" else "GZIP"
 
-    def _put_file(self, fpath: str, stage: str, prefix: str) -> str:
-        """Uploads a file to stage and returns resulted fpath in stage.
-        Due to compression the resulting filename in stage can have an extra prefix (e.g. ".gz").
+    def _put_file(self, file_stream, stage: str, fpath: str) -> str:
+        """Uploads an already compressed file object to stage and returns resulted fpath in stage.
+        File object is streamed by the connector, the local path in PUT statement
+        is only used to name the file in stage.
         """
-        cursor = self.conn.cursor().execute(f"PUT 'file://{fpath}' '{stage}/{prefix}'")
+        prefix, fname = fpath.rsplit("/", 1)
+        src = quote_string("file://" + fname)
+        dst = quote_string(stage + "/" + prefix)
+        cursor = self.conn.cursor().execute(
+            f"PUT {src} {dst} AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = {self._compression_sql}",
+            file_stream=file_stream,
+        )
         return prefix + "/" + cursor.fetchone()[1]
 
     def flush_all_table_buffers(self) -> None:
-        for table_path in list(self._table_buffers):
-            self.flush_table_buffer(table_path)
+        self._deferred_removals = []
+        try:
+            self._flush_table_buffers(list(self._table_buffers))
+        finally:
+            # files staged by this flush are removed with as few statements as possible
+            fpaths, self._deferred_removals = self._deferred_removals, None
+            if fpaths:
+                self.clear_stage(fpaths)
+
+    def _flush_table_buffers(self, table_paths: List[str]) -> None:
+        if self._max_upload_workers < 2:
+            # previously failed uploads are retried first, a failing one is queued
+            # again (at the end) and its error stops the flush
+            for _ in range(len(self._failed_uploads)):
+                self._stage_table_buffer(*self._failed_uploads.pop(0))
+            for table_path in table_paths:
+                self.flush_table_buffer(table_path)
+            return
+
+        # uploads are network bound so they are done concurrently, everything
+        # else (bookkeeping, table manipulation) still happens sequentially
+        retries, self._failed_uploads = self._failed_uploads, []
+        for retry in retries:
+            self._submit_upload(*retry)
+        for table_path in table_paths:
+            self._upload_in_background(table_path)
+        self._collect_background_uploads()
 
     def get_column_types(self, table_path: str) -> Dict[str, str]:
-        columns = self._predefined_column_types.get(table_path, {})
+        columns = self._column_types_cache.get(table_path)
+        if columns is None:
+            columns = self._compute_column_types(table_path)
+            self._column_types_cache[table_path] = columns
+        return columns
+
+    def _compute_column_types(self, table_path: str) -> Dict[str, str]:
+        columns = dict(self._predefined_column_types.get(table_path, {}))
         if columns and self._ignore_unexpected_fields:
             return columns
 
@@ -208,8 +594,11 @@ class SnowflakeStageExporter(AbstractContextManager):
         return columns
 
     def create_table(self, table_path: str) -> None:
+        self._execute_statements(self._create_table_statements(table_path))
+
+    def _create_table_statements(self, table_path: str) -> List[_Statement]:
         if table_path in self._created_tables_for:
-            return
+            return []
         logger.info("Creating table %r", table_path)
         cols = ", ".join(
             [
@@ -217,39 +606,89 @@ class SnowflakeStageExporter(AbstractContextManager):
                 for col, coltype in self.get_column_types(table_path).items()
             ]
         )
-        self.conn.cursor().execute(f"CREATE TABLE IF NOT EXISTS {table_path} ({cols})")
-        self._created_tables_for.add(table_path)
+        return [
+            (
+                f"CREATE TABLE IF NOT EXISTS {table_path} ({cols})",
+                partial(self._created_tables_for.add, table_path),
+            )
+        ]
 
     def populate_table(self, table_path: str) -> None:
+        self._execute_statements(self._populate_table_statements(table_path))
+
+    def _populate_table_statements(self, table_path: str) -> List[_Statement]:
         logger.info("Populating table %r", table_path)
         new_fpaths = [
             fp
             for fp in self._exported_fpaths[table_path]
             if fp not in self._copied_fpaths
         ]
-        coltypes = self.get_column_types(table_path)
-        cols = ", ".join(map(normalize_identifier, coltypes))
-        safe_fields = [field.replace('"', '""') for field in coltypes]
-        json_select = ", ".join(f'$1:"{field}"' for field in safe_fields)
-        for fpaths in chunk(new_fpaths, 1000):
-            fpaths_expr = ", ".join(f"'{fpath}'" for fpath in fpaths)
-            self.conn.cursor().execute(
-                f"""
+        if not new_fpaths:
+            return []
+        cols, json_select = self._copy_columns_sql(table_path)
+        statements: List[_Statement] = []
+        for fpaths in chunk(new_fpaths, self.max_files_per_copy):
+            fpaths_expr = ", ".join(map(quote_string, fpaths))
+            sql = f"""
                 COPY INTO {table_path} ({cols})
                     FROM (SELECT {json_select} FROM {self._stage})
-                    FILE_FORMAT = (TYPE = JSON)
+                    FILE_FORMAT = (TYPE = JSON COMPRESSION = {self._compression_sql})
                     FILES = ({fpaths_expr})
                 """
+            statements.append((sql, partial(self._copied_fpaths.update, fpaths)))
+        return statements
+
+    def _execute_statements(self, statements: List[_Statement]) -> None:
+        """Executes statements in a single request (multi-statement if needed) and
+        runs their callbacks once all of them succeeded. A failed request is safe
+        to retry as a whole: tables are created with IF NOT EXISTS and COPY INTO
+        skips already loaded files.
+        """
+        if not statements:
+            return
+        sqls = [sql for sql, _ in statements]
+        cursor = self.conn.cursor()
+        if len(sqls) == 1:
+            cursor.execute(sqls[0])
+        else:
+            cursor.execute(";\n".join(sqls), num_statements=len(sqls))
+        for _, on_success in statements:
+            on_success()
+
+    def _copy_columns_sql(self, table_path: str) -> Tuple[str, str]:
+        """Returns column list and JSON select list for COPY INTO statements of a table.
+        Both are rebuilt only when column types of the table change.
+        """
+        coltypes = self.get_column_types(table_path)
+        cached = self._copy_columns_cache.get(table_path)
+        if cached is None or cached[0] is not coltypes:
+            cols = ", ".join(map(normalize_identifier, coltypes))
+            json_select = ", ".join(
+                ['$1:"' + field.replace('"', '""') + '"' for field in coltypes]
             )
-            self._copied_fpaths.update(fpaths)
+            cached = (coltypes, cols, json_select)
+            self._copy_columns_cache[table_path] = cached
+        return cached[1], cached[2]
 
     def create_all_tables(self) -> None:
-        for table_path in self._exported_fpaths:
-            self.create_table(table_path)
+        self._execute_statements(self._create_all_tables_statements())
+
+    def _create_all_tables_statements(self) -> List[_Statement]:
+        return [
+            statement
+            for table_path in self._exported_fpaths
+            for statement in self._create_table_statements(table_path)
+        ]
 
     def populate_all_tables(self) -> None:
-        for table_path in self._exported_fpaths:
-            self.populate_table(table_path)
+        self._execute_statements(self._populate_all_tables_statements())
+
+    def _populate_all_tables_statements(self) -> List[_Statement]:
+        return [
+            statement
+            for table_path in self._exported_fpaths
+            for statement in self._populate_table_statements(table_path)
+        ]
 
     def clear_stage(self, fpaths: Iterable[str] = None) -> None:
         if fpaths is None:
@@ -261,16 +700,37 @@ class SnowflakeStageExporter(AbstractContextManager):
             fpaths = list(fpaths or [])
             count_msg = str(len(fpaths))
         logger.info("Removing %s staged files", count_msg)
-        if fpaths:
-            self.conn.cursor().executemany(
-                "REMOVE %s", [(f"{self._stage}/{fpath}",) for fpath in fpaths]
+        # files are removed with a single statement per stage directory
+        fnames_by_prefix: Dict[str, List[str]] = {}
+        for fpath in fpaths:
+            prefix, _, fname = fpath.rpartition("/")
+            fnames_by_prefix.setdefault(prefix, []).append(fname)
+        # PATTERN is matched against full paths as LIST shows them, which start with
+        # the stage name for named stages (but not for user / table stages), so it's
+        # anchored to match files directly in the directory only (not nested ones)
+        stage_name_re = "" if self._stage[1] in "~%" else "[^/]+/"
+        cursor = self.conn.cursor()
+        for prefix, fnames in fnames_by_prefix.items():
+            location = f"{self._stage}/{prefix}/" if prefix else f"{self._stage}/"
+            dir_re = (
+                "^" + stage_name_re + (escape_regex(prefix + "/") if prefix else "")
             )
+            for chunk_fnames in chunk(fnames, self.max_files_per_remove):
+                if len(chunk_fnames) == 1:
+                    cursor.execute("REMOVE %s", (location + chunk_fnames[0],))
+                    continue
+                pattern = (
+                    dir_re + "(" + "|".join(map(escape_regex, chunk_fnames)) + ")$"
+                )
+                cursor.execute("REMOVE %s PATTERN = %s", (location, pattern))
 
     def finish_export(self) -> None:
         self.flush_all_table_buffers()
+        statements = []
         if self._create_tables_on == "finish":
-            self.create_all_tables()
+            statements += self._create_all_tables_statements()
         if self._populate_tables_on == "finish":
-            self.populate_all_tables()
+            statements += self._populate_all_tables_statements()
+        self._execute_statements(statements)
         if self._clear_stage_on == "finish":
             self.clear_stage()
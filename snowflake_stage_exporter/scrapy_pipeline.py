@@ -16,6 +16,7 @@ class SnowflakePipeline:
         "predefined_column_types": "getdict",
         "ignore_unexpected_fields": "getbool",
         "allow_varying_value_types": "getbool",
+        "max_upload_workers": "getint",
     }
 
     def __init__(self, settings):
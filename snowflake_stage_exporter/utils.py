@@ -1,25 +1,97 @@
 import re
+from functools import lru_cache
 from hashlib import sha256
-from typing import Iterable, Tuple
+from itertools import islice
+from string import Formatter
+from typing import Iterable, Optional, Tuple, Union
 
 
 def chunk(iterable: Iterable, n: int) -> Iterable[Tuple]:
-    current_chunk = []
-    for el in iterable:
-        current_chunk.append(el)
-        if len(current_chunk) == n:
-            yield tuple(current_chunk)
-            current_chunk = []
-    if current_chunk:
-        yield tuple(current_chunk)
+    iterator = iter(iterable)
+    while True:
+        current_chunk = tuple(islice(iterator, n))
+        if not current_chunk:
+            return
+        yield current_chunk
 
 
+# maps every ASCII character not allowed in unquoted identifiers to a space
+_IDENTIFIER_TRANSLATION = str.maketrans(
+    {c: " " for c in map(chr, range(128)) if not (c.isalnum() or c in "_$")}
+)
+_IDENTIFIER_SEPARATOR_RE = re.compile(r"(?i)[^a-z\d_$]+")
+_REGEX_SPECIAL_RE = re.compile(r"([\\.^$|?*+()\[\]{}])")
+_ITEM_KEY_FIELD_RE = re.compile(r"item\[([^\[\]]+)\]")
+_FIELD_ACCESSOR_RE = re.compile(r"[.\[]")
+
+
+def quote_string(value: str) -> str:
+    """Returns value as a single quoted Snowflake string literal."""
+    if "'" in value or "\\" in value:
+        value = value.replace("\\", "\\\\").replace("'", "\\'")
+    return "'" + value + "'"
+
+
+def escape_regex(value: str) -> str:
+    """Escapes value for literal matching in POSIX regular expressions
+    (as used by PATTERN of Snowflake LIST / REMOVE / COPY INTO).
+    """
+    return _REGEX_SPECIAL_RE.sub(r"\\\1", value)
+
+
+@lru_cache(maxsize=4096)
 def normalize_identifier(value: str) -> str:
-    orig_value = value
-    value = re.sub(r"(?i)[^a-z\d_$]+", " ", value).strip()
-    if not value:
-        return "_empty_" + sha256(orig_value.encode("utf8")).hexdigest()[:6]
-    value = re.sub(r" +", "_", value)
-    if not re.match(r"(?i)[_a-z]", value):
-        value = "_" + value
-    return value
+    if value.isascii():
+        parts = value.translate(_IDENTIFIER_TRANSLATION).split()
+    else:
+        parts = _IDENTIFIER_SEPARATOR_RE.sub(" ", value).split()
+    if not parts:
+        # NOTE: the suffix ends up in column names of existing tables, so it must
+        # stay the same across versions and machines - don't swap the hash function
+        return "_empty_" + sha256(value.encode("utf8")).hexdigest()[:6]
+    normalized = "_".join(parts)
+    if not (normalized[0] == "_" or normalized[0].isalpha()):
+        normalized = "_" + normalized
+    return normalized
+
+
+def _field_root(field: str) -> str:
+    """Returns top level name of a `str.format` field (e.g. `"a.b[c]"` -> `"a"`)."""
+    return _FIELD_ACCESSOR_RE.split(field, maxsplit=1)[0]
+
+
+def template_fields(template: str) -> Tuple[str, ...]:
+    """Returns sorted unique top level names referenced by a `str.format` template
+    (e.g. `"{a}_{item[b]}_{spider.name}"` -> `("a", "item", "spider")`).
+    """
+    fields = set()
+    for _, field, _, _ in Formatter().parse(template):
+        if field is not None:
+            fields.add(_field_root(field))
+    return tuple(sorted(fields))
+
+
+def template_field_names(template: str) -> Tuple[str, ...]:
+    """Returns sorted unique field names of a `str.format` template, including
+    attribute / index accessors (e.g. `"{a}_{spider.name}"` -> `("a", "spider.name")`).
+    """
+    return tuple(
+        sorted({f for _, f, _, _ in Formatter().parse(template) if f is not None})
+    )
+
+
+def template_item_keys(template: str) -> Optional[Tuple[Union[str, int], ...]]:
+    """Returns sorted unique keys of `{item[key]}` fields of a `str.format` template,
+    or `None` if `item` is referenced in any other way (e.g. `{item.a}`, `{item[a][b]}`).
+    Numeric keys are returned as `int` since that's how `str.format` looks them up.
+    """
+    keys = set()
+    for _, field, _, _ in Formatter().parse(template):
+        if field is None or _field_root(field) != "item":
+            continue
+        match = _ITEM_KEY_FIELD_RE.fullmatch(field)
+        if match is None:
+            return None
+        key = match.group(1)
+        keys.add(int(key) if key.isdigit() else key)
+    return tuple(sorted(keys, key=str))
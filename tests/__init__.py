@@ -1,16 +1,24 @@
 # pylint: disable=unused-argument,protected-access
-import os
+import gzip
 import re
+import zlib
 from contextlib import contextmanager
-from unittest.mock import MagicMock, Mock, patch
+from unittest.mock import DEFAULT, MagicMock, Mock, patch
 
 from snowflake_stage_exporter import SnowflakeStageExporter
 
 
 @contextmanager
-def make_test_exporter(table_path, patch_put=True, **kwargs):
-    def _put_file(fpath, stage, prefix):
-        return prefix + "/" + os.path.basename(fpath)
+def make_test_exporter(table_path, patch_put=True, put_file=None, **kwargs):
+    """With `put_file` set, uploads call `put_file(fpath, content)` with decompressed
+    content of the file, it may raise or return the fpath in stage (None keeps it).
+    """
+
+    def _put_file(file_stream, stage, fpath):
+        if put_file is None:
+            return fpath
+        staged_fpath = put_file(fpath, read_staged_file(exporter, file_stream))
+        return fpath if staged_fpath is None else staged_fpath
 
     with patch("snowflake.connector", MagicMock()), SnowflakeStageExporter(
         "user", "pass", "account", table_path, **kwargs
@@ -21,17 +29,59 @@ def make_test_exporter(table_path, patch_put=True, **kwargs):
         yield exporter
 
 
+def buffer_size(exporter, table_path):
+    """Uncompressed size of a table buffer, including lines not written yet."""
+    return exporter._table_buffers[table_path].tell() + len(
+        exporter._pending_writes[table_path]
+    )
+
+
+def read_staged_file(exporter, file_stream):
+    file_stream.seek(0)
+    data = file_stream.read()
+    if exporter._compression == "zstd":
+        import zstandard  # pylint: disable=import-outside-toplevel
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+
+def record_put_calls(exporter, staged_fname):
+    """Makes PUT statements stage files as `staged_fname` and records
+    decompressed content of each uploaded file by its PUT statement.
+    """
+    staged = {}
+
+    def execute(sql, *args, file_stream=None, **kwargs):
+        if file_stream is not None:
+            staged[sql] = read_staged_file(exporter, file_stream)
+        return DEFAULT
+
+    cursor = exporter.conn.cursor()
+    cursor.execute.side_effect = execute
+    cursor.execute.return_value.fetchone.return_value = (None, staged_fname)
+    return staged
+
+
 def read_table_buffer(exporter, table_path):
+    exporter._write_pending(table_path)
     buffer = exporter._table_buffers[table_path]
     buffer.flush()
-    with open(buffer.name, encoding="utf8") as f:
-        return f.read()
+    with open(buffer.fileobj.name, "rb") as f:
+        # gzip stream isn't finished yet, so decompress without expecting a trailer
+        return zlib.decompressobj(wbits=31).decompress(f.read()).decode("utf8")
 
 
 def mock_calls_get_sql(calls):
+    """Multi-statement calls are split into one entry per statement."""
     cleaned = []
     for call in calls:
         try:
+            if call.kwargs.get("num_statements"):
+                sqls = call.args[0].split(";\n")
+                assert len(sqls) == call.kwargs["num_statements"]
+                cleaned.extend((re.sub(r"\n+\s+", " ", sql).strip(),) for sql in sqls)
+                continue
             value = (re.sub(r"\n+\s+", " ", call.args[0]).strip(), *call.args[1:])
         except Exception:  # pylint: disable=broad-except
             value = call
@@ -1,12 +1,25 @@
-# pylint: disable=redefined-outer-name,protected-access,no-member,unspecified-encoding
-import fnmatch
-from unittest.mock import call
-
+# pylint: disable=redefined-outer-name,protected-access,no-member,unspecified-encoding,unused-argument
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum, IntEnum
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import orjson
 import pytest
 import snowflake  # type: ignore
 
-from snowflake_stage_exporter import SnowflakeStageExporterError
-from tests import make_test_exporter, mock_calls_get_sql, read_table_buffer
+from snowflake_stage_exporter import SnowflakeStageExporter, SnowflakeStageExporterError
+from tests import (
+    buffer_size,
+    make_test_exporter,
+    mock_calls_get_sql,
+    read_table_buffer,
+    record_put_calls,
+)
 
 
 def test_basic_flow():
@@ -16,10 +29,10 @@ def test_basic_flow():
         exporter.export_item({"myfield": 2, "x": {}}, something="bar")
 
         assert set(exporter._table_buffers.keys()) == {"foo_1", "bar_2"}
-        assert read_table_buffer(exporter, "foo_1") == '{"myfield": 1}\n'
+        assert read_table_buffer(exporter, "foo_1") == '{"myfield":1}\n'
         assert (
             read_table_buffer(exporter, "bar_2")
-            == '{"myfield": 2}\n{"myfield": 2, "x": {}}\n'
+            == '{"myfield":2}\n{"myfield":2,"x":{}}\n'
         )
 
         exporter.finish_export()
@@ -31,21 +44,96 @@ def test_basic_flow():
             ("CREATE TABLE IF NOT EXISTS bar_2 (myfield NUMBER, x OBJECT)",),
             (
                 'COPY INTO foo_1 (myfield) FROM (SELECT $1:"myfield" FROM @~) FILE_FORMAT = '
-                "(TYPE = JSON) FILES = ('foo_1/INSTANCE_MS_1.jl')",
+                "(TYPE = JSON COMPRESSION = GZIP) FILES = ('foo_1/INSTANCE_MS_1.jl.gz')",
             ),
             (
                 'COPY INTO bar_2 (myfield, x) FROM (SELECT $1:"myfield", $1:"x" FROM @~) '
-                "FILE_FORMAT = (TYPE = JSON) FILES = ('bar_2/INSTANCE_MS_1.jl')",
+                "FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) FILES = ('bar_2/INSTANCE_MS_1.jl.gz')",
             ),
         ]
     exporter.conn.close.assert_called()
 
 
+def test_multi_statement_finish():
+    with make_test_exporter("{table}") as exporter:
+        exporter.export_item({"a": 1}, table="a")
+        exporter.export_item({"a": 1}, table="b")
+        exporter.finish_export()
+        execute = exporter.conn.cursor().execute
+        # CREATE TABLE and COPY INTO statements of all tables in a single request
+        execute.assert_called_once()
+        assert execute.call_args.kwargs == {"num_statements": 4}
+        assert exporter._created_tables_for == {"a", "b"}
+        assert exporter._copied_fpaths == {
+            "a/INSTANCE_MS_1.jl.gz",
+            "b/INSTANCE_MS_1.jl.gz",
+        }
+
+
+def test_table_path_cache():
+    with make_test_exporter("DB.{table}") as exporter:
+        assert exporter.export_item({"a": 1}, table="a b", other=1) == "DB.a_b"
+        assert exporter.export_item({"a": 1}, table="a b", other=2) == "DB.a_b"
+        assert exporter.export_item({"a": 1}, table="c", other=[]) == "DB.c"
+        assert exporter.export_item({"a": 1}, table=["unhashable"]) == "DB.unhashable"
+        assert exporter.export_item({"a": 1}, table=1) == "DB._1"
+        assert exporter.export_item({"a": 1}, table=True) == "DB.True"
+        assert exporter.export_item({"a": 1}, table=1.0) == "DB._1._0"
+        assert exporter._table_path_cache == {
+            ("a b", str): "DB.a_b",
+            ("c", str): "DB.c",
+            (1, int): "DB._1",
+            (True, bool): "DB.True",
+            (1.0, float): "DB._1._0",
+        }
+    with make_test_exporter("DB.{spider.category}_{params[n]}") as exporter:
+        spider = SimpleNamespace(category="a")
+        params = {"n": 1}
+        assert exporter.export_item({}, spider=spider, params=params) == "DB.a_1"
+        spider.category = "b"
+        assert exporter.export_item({}, spider=spider, params=params) == "DB.b_1"
+        params["n"] = 2
+        assert exporter.export_item({}, spider=spider, params=params) == "DB.b_2"
+        assert exporter.export_item({}, spider=spider, params=params) == "DB.b_2"
+        assert exporter._table_path_cache == {
+            (1, "a", int, str): "DB.a_1",
+            (1, "b", int, str): "DB.b_1",
+            (2, "b", int, str): "DB.b_2",
+        }
+    with make_test_exporter("DB.{item[table]}") as exporter:
+        assert exporter.export_item({"table": "a"}) == "DB.a"
+        assert exporter.export_item({"table": "b"}) == "DB.b"
+        assert exporter.export_item({"table": "b c"}) == "DB.b_c"
+        assert exporter.export_item({"table": "b c"}) == "DB.b_c"
+        assert exporter.export_item({"table": 1}) == "DB._1"
+        assert exporter.export_item({"table": True}) == "DB.True"
+        assert exporter.export_item({"table": ["unhashable"]}) == "DB.unhashable"
+        assert exporter._table_path_cache == {
+            ("a", str): "DB.a",
+            ("b", str): "DB.b",
+            ("b c", str): "DB.b_c",
+            (1, int): "DB._1",
+            (True, bool): "DB.True",
+        }
+    with make_test_exporter("DB.T_{item[name]:.1}") as exporter:
+        exporter.max_cached_table_paths = 10
+        for n in range(100):
+            assert exporter.export_item({"name": f"a{n}"}) == "DB.T_a"
+        assert len(exporter._table_path_cache) == 10
+        assert exporter._normalized_table_paths == {"DB.T_a": "DB.T_a"}
+    with make_test_exporter("DB.{item[table][0]}") as exporter:
+        assert exporter.export_item({"table": "a"}) == "DB.a"
+        assert exporter.export_item({"table": "b"}) == "DB.b"
+        assert exporter._table_path_cache == {}
+        assert exporter._normalized_table_paths == {"DB.a": "DB.a", "DB.b": "DB.b"}
+
+
 @pytest.mark.parametrize(
     "kwargs",
     [
         dict(create_tables_on=""),
         dict(clear_stage_on="neyvar"),
+        dict(compression="lz4"),
         dict(stage="x"),
         dict(stage="x/"),
         dict(stage="@x/z"),
@@ -60,6 +148,13 @@ def test_bad_configuration(kwargs):
             pass
 
 
+def test_zstd_not_installed():
+    with patch("snowflake_stage_exporter.zstandard", None):
+        with pytest.raises(ImportError, match="zstandard"):
+            with make_test_exporter("table", compression="zstd"):
+                pass
+
+
 def test_clear_stage():
     with make_test_exporter("{table}", clear_stage_on="finish") as exporter:
         assert exporter.export_item({"myfield": 1}, table="a")
@@ -70,30 +165,71 @@ def test_clear_stage():
             ("CREATE TABLE IF NOT EXISTS b (myfield NUMBER)",),
             (
                 'COPY INTO a (myfield) FROM (SELECT $1:"myfield" FROM @~) FILE_FORMAT = (TYPE '
-                "= JSON) FILES = ('a/INSTANCE_MS_1.jl')",
+                "= JSON COMPRESSION = GZIP) FILES = ('a/INSTANCE_MS_1.jl.gz')",
             ),
             (
                 'COPY INTO b (myfield) FROM (SELECT $1:"myfield" FROM @~) FILE_FORMAT = (TYPE '
-                "= JSON) FILES = ('b/INSTANCE_MS_1.jl')",
+                "= JSON COMPRESSION = GZIP) FILES = ('b/INSTANCE_MS_1.jl.gz')",
             ),
-            ("REMOVE %s", [("@~/a/INSTANCE_MS_1.jl",), ("@~/b/INSTANCE_MS_1.jl",)]),
+            ("REMOVE %s", ("@~/a/INSTANCE_MS_1.jl.gz",)),
+            ("REMOVE %s", ("@~/b/INSTANCE_MS_1.jl.gz",)),
         ]
     with make_test_exporter("table") as exporter:
         exporter.clear_stage(["aa", "bb"])
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
-            ("REMOVE %s", [("@~/aa",), ("@~/bb",)])
+            ("REMOVE %s PATTERN = %s", ("@~/", "^(aa|bb)$"))
+        ]
+
+
+def test_clear_stage_chunks():
+    with make_test_exporter("table") as exporter:
+        exporter.max_files_per_remove = 2
+        exporter.clear_stage(["a/1", "a/2", "b/1", "a/3.(x)"])
+        assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
+            ("REMOVE %s PATTERN = %s", ("@~/a/", "^a/(1|2)$")),
+            ("REMOVE %s", ("@~/a/3.(x)",)),
+            ("REMOVE %s", ("@~/b/1",)),
         ]
 
 
+@pytest.mark.parametrize(
+    "stage, prefix, listed_fpath, expected",
+    [
+        ("@~", "", "aa", True),
+        ("@~", "", "x/aa", False),
+        ("@~", "", "aaa", False),
+        ("@~", "x.y", "x.y/aa", True),
+        ("@~", "x.y", "x.y/z/aa", False),
+        ("@~", "x.y", "xzy/aa", False),
+        ("@%table", "x", "x/bb", True),
+        ("@st", "", "st/aa", True),
+        ("@st", "", "st/x/aa", False),
+        ("@db.schema.st", "x/y", "st/x/y/bb", True),
+        ("@db.schema.st", "x/y", "st/x/y/z/bb", False),
+    ],
+)
+def test_clear_stage_pattern(stage, prefix, listed_fpath, expected):
+    with make_test_exporter("table", stage=stage) as exporter:
+        exporter.clear_stage(
+            [f"{prefix}/aa", f"{prefix}/bb"] if prefix else ["aa", "bb"]
+        )
+        sqls = mock_calls_get_sql(exporter.conn.cursor().mock_calls)
+    assert len(sqls) == 1
+    pattern = sqls[0][1][1]
+    # only files directly in the directory match, same named nested ones don't
+    assert bool(re.search(pattern, listed_fpath)) == expected
+
+
 def test_chunking():
-    buffer_sizes = {}
-    with make_test_exporter("table", max_file_size=2 ** 10 * 100) as exporter:
+    buffer_sizes = []
+    with make_test_exporter(
+        "table", max_file_size=2 ** 10 * 100, max_upload_workers=1
+    ) as exporter:
         # patch `exporter.flush_table_buffer` to track buffer sizes upon flush
         orig = exporter.flush_table_buffer
 
         def flush_table_buffer(table_path):
-            buffer = exporter._table_buffers[table_path]
-            buffer_sizes[buffer.name] = buffer.tell()
+            buffer_sizes.append(buffer_size(exporter, table_path))
             return orig(table_path)
 
         exporter.flush_table_buffer = flush_table_buffer
@@ -102,32 +238,229 @@ def test_chunking():
         for _ in range(100):
             exporter.export_item({"a": large_string})
         exporter.finish_export()
+        # a single temporary file is reused by all the buffers
+        assert len(exporter._buffer_files_pool) == 1
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
             ("CREATE TABLE IF NOT EXISTS table (a VARCHAR)",),
             (
-                'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                "FILES = ('table/INSTANCE_MS_1.jl', 'table/INSTANCE_MS_2.jl', "
-                "'table/INSTANCE_MS_3.jl', 'table/INSTANCE_MS_4.jl', "
-                "'table/INSTANCE_MS_5.jl')",
+                'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                "FILES = ('table/INSTANCE_MS_1.jl.gz', 'table/INSTANCE_MS_2.jl.gz', "
+                "'table/INSTANCE_MS_3.jl.gz', 'table/INSTANCE_MS_4.jl.gz', "
+                "'table/INSTANCE_MS_5.jl.gz')",
             ),
         ]
-    assert list(buffer_sizes.values()) == [105210, 105210, 105210, 105210, 80160]
+    assert buffer_sizes == [105189, 105189, 105189, 105189, 80144]
+
+
+def test_pending_writes():
+    with make_test_exporter("table") as exporter:
+        exporter.write_chunk_size = 20
+        exporter.export_item({"a": 1})
+        assert exporter._table_buffers["table"].tell() == 0
+        assert exporter._pending_writes["table"] == b'{"a":1}\n'
+        exporter.export_item({"a": 2})
+        exporter.export_item({"a": 3})
+        assert exporter._table_buffers["table"].tell() == 24
+        assert exporter._pending_writes["table"] == b""
+        assert buffer_size(exporter, "table") == 24
 
 
 def test_put_file():
-    # pylint: disable=no-value-for-parameter
     with make_test_exporter("table", patch_put=False) as exporter:
+        staged = record_put_calls(exporter, "STAGED.jl.gz")
+        exporter.export_item({"a": 1})
+        exporter.finish_export()
+        put_call = exporter.conn.cursor().execute.mock_calls[0]
+        assert staged == {
+            "PUT 'file://INSTANCE_MS_1.jl.gz' '@~/table' "
+            "AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = GZIP": b'{"a":1}\n',
+        }
+        # uploaded file is kept for reuse by the next buffer
+        assert exporter._buffer_files_pool == [put_call.kwargs["file_stream"]]
+        assert put_call.kwargs["file_stream"].tell() == 0
+        # name of the file in stage is taken from PUT result
+        assert exporter._exported_fpaths == {"table": ["table/STAGED.jl.gz"]}
+    assert put_call.kwargs["file_stream"].closed
+
+
+def test_staged_file_is_gzipped():
+    staged = {}
+    with make_test_exporter("table", put_file=staged.__setitem__) as exporter:
         exporter.export_item({"a": 1})
+        exporter.export_item({"a": 2})
+        exporter.finish_export()
+    assert staged == {"table/INSTANCE_MS_1.jl.gz": b'{"a":1}\n{"a":2}\n'}
+
+
+def test_tmp_dir(tmp_path):
+    with make_test_exporter("table", tmp_dir=str(tmp_path)) as exporter:
+        exporter.export_item({"a": 1})
+        buffer_fpath = exporter._table_buffers["table"].fileobj.name
+        assert os.path.dirname(buffer_fpath) == str(tmp_path)
+        exporter.finish_export()
+    assert not os.listdir(tmp_path)
+
+
+def test_zstd_compression():
+    pytest.importorskip("zstandard")
+    with make_test_exporter(
+        "table", compression="zstd", max_file_size=16, patch_put=False
+    ) as exporter:
+        staged = record_put_calls(exporter, "STAGED.jl.zst")
+        for n in range(3):
+            exporter.export_item({"a": n})
+        # buffers are rotated on uncompressed size
+        assert buffer_size(exporter, "table") == 8
         exporter.finish_export()
-        sql = mock_calls_get_sql(exporter.conn.cursor().mock_calls)[0][0]
-        assert fnmatch.fnmatch(
-            sql,
-            "PUT 'file:///tmp/*/INSTANCE_MS_1.jl' '@~/table'",
+        assert staged == {
+            "PUT 'file://INSTANCE_MS_1.jl.zst' '@~/table' "
+            "AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = ZSTD": b'{"a":0}\n{"a":1}\n',
+            "PUT 'file://INSTANCE_MS_2.jl.zst' '@~/table' "
+            "AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = ZSTD": b'{"a":2}\n',
+        }
+        assert "FILE_FORMAT = (TYPE = JSON COMPRESSION = ZSTD)" in (
+            mock_calls_get_sql(exporter.conn.cursor().mock_calls)[-1][0]
         )
-        assert (
-            exporter.conn.cursor().execute().fetchone().__getitem__.call_args_list
-            == [call(1)]
+
+
+def test_failed_upload_retry():
+    put_file = MagicMock(side_effect=[RuntimeError("failed"), "staged"])
+    with make_test_exporter(
+        "table", max_upload_workers=1, put_file=put_file
+    ) as exporter:
+        exporter.export_item({"a": 1})
+        with pytest.raises(RuntimeError, match="failed"):
+            exporter.flush_table_buffer("table")
+        assert exporter._table_buffers == {}
+        [(_, tmp_file, fpath)] = exporter._failed_uploads
+        assert fpath == "table/INSTANCE_MS_1.jl.gz"
+        assert exporter._buffer_files_pool == []
+        exporter.finish_export()
+        assert exporter._failed_uploads == []
+        assert exporter._buffer_files_pool == [tmp_file]
+        assert exporter._exported_fpaths == {"table": ["staged"]}
+    put_file = MagicMock(side_effect=RuntimeError("failed"))
+    with make_test_exporter(
+        "table", max_upload_workers=1, put_file=put_file
+    ) as exporter:
+        exporter.export_item({"a": 1})
+        with pytest.raises(RuntimeError, match="failed"):
+            exporter.finish_export()
+        [(_, tmp_file, _)] = exporter._failed_uploads
+    # files of never staged buffers are closed along with the exporter
+    assert tmp_file.closed
+
+
+@pytest.mark.parametrize("max_upload_workers", [1, 4])
+def test_concurrent_uploads(max_upload_workers):
+    threads = {}
+    failing = {"c"}
+
+    def put_file(fpath, content):
+        threads[fpath] = threading.current_thread()
+        if fpath.split("/")[0] in failing:
+            raise RuntimeError("failed upload")
+
+    with make_test_exporter(
+        "{table}", max_upload_workers=max_upload_workers, put_file=put_file
+    ) as exporter:
+        for table in ("a", "b", "c", "d"):
+            exporter.export_item({"a": 1}, table=table)
+        with pytest.raises(RuntimeError, match="failed upload"):
+            exporter.flush_all_table_buffers()
+        expected_fpaths = {
+            "a": ["a/INSTANCE_MS_1.jl.gz"],
+            "b": ["b/INSTANCE_MS_1.jl.gz"],
+            "c": [],
+        }
+        if max_upload_workers == 1:
+            # sequential flushing stops on first error
+            assert list(exporter._table_buffers) == ["d"]
+        else:
+            # concurrent flushing records every successful upload
+            assert exporter._table_buffers == {}
+            expected_fpaths["d"] = ["d/INSTANCE_MS_1.jl.gz"]
+        assert exporter._exported_fpaths == expected_fpaths
+        # failed batch is kept to be retried by the next flush
+        assert [
+            (table_path, fpath) for table_path, _, fpath in exporter._failed_uploads
+        ] == [("c", "c/INSTANCE_MS_1.jl.gz")]
+        failing.clear()
+        exporter.finish_export()
+        assert exporter._failed_uploads == []
+        assert exporter._exported_fpaths == {
+            table: [f"{table}/INSTANCE_MS_1.jl.gz"] for table in ("a", "b", "c", "d")
+        }
+        assert any(
+            sql.endswith("FILES = ('c/INSTANCE_MS_1.jl.gz')")
+            for sql, *_ in mock_calls_get_sql(exporter.conn.cursor().mock_calls)
         )
+    used_main_thread = {t is threading.main_thread() for t in threads.values()}
+    assert used_main_thread == {max_upload_workers == 1}
+
+
+def test_background_uploads():
+    release_uploads = threading.Event()
+
+    def put_file(fpath, content):
+        assert threading.current_thread() is not threading.main_thread()
+        release_uploads.wait(5)
+
+    with make_test_exporter("table", max_file_size=10, put_file=put_file) as exporter:
+        for n in range(4):
+            exporter.export_item({"a": n})
+        # exporting goes on while full buffers are being uploaded
+        assert len(exporter._background_uploads) == 2
+        assert exporter._exported_fpaths == {"table": []}
+        release_uploads.set()
+        exporter.export_item({"a": 4})
+        exporter.finish_export()
+        assert exporter._background_uploads == []
+        assert exporter._exported_fpaths == {
+            "table": [f"table/INSTANCE_MS_{n}.jl.gz" for n in range(1, 4)]
+        }
+
+
+def test_background_upload_failure(caplog):
+    failing = {"table/INSTANCE_MS_1.jl.gz"}
+
+    def put_file(fpath, content):
+        if fpath in failing:
+            raise RuntimeError("failed upload")
+
+    with make_test_exporter(
+        "table", max_file_size=10, max_upload_workers=2, put_file=put_file
+    ) as exporter:
+        for n in range(5):
+            exporter.export_item({"a": n})
+        # collected while exporting an unrelated item, which isn't affected
+        exporter.export_item({"b": "x"})
+        assert "Failed to upload 'table/INSTANCE_MS_1.jl.gz'" in caplog.text
+        assert [fpath for _, _, fpath in exporter._failed_uploads] == [
+            "table/INSTANCE_MS_1.jl.gz"
+        ]
+        assert exporter._recorded_coltypes == {
+            "table": {"a": {"NUMBER"}, "b": {"VARCHAR"}}
+        }
+        failing.clear()
+        exporter.finish_export()
+        assert exporter._failed_uploads == []
+        assert sorted(exporter._exported_fpaths["table"]) == [
+            f"table/INSTANCE_MS_{n}.jl.gz" for n in range(1, 4)
+        ]
+
+
+def test_close_collects_background_uploads(caplog):
+    put_file = MagicMock(side_effect=RuntimeError("failed upload"))
+    with make_test_exporter(
+        "table", max_file_size=10, max_upload_workers=2, put_file=put_file
+    ) as exporter:
+        exporter.export_item({"a": 1})
+        exporter.export_item({"a": 2})
+        tmp_file = exporter._background_uploads[0][1]
+    assert exporter._background_uploads == []
+    assert "Closing with 1 buffer(s) that failed to upload" in caplog.text
+    assert tmp_file.closed
 
 
 def test_predefined_fields():
@@ -144,7 +477,7 @@ def test_predefined_fields():
             exporter.export_item({"a": 1.1, "b": 2, "c": 3, "e": {}}, table=table)
             assert (
                 read_table_buffer(exporter, table)
-                == '{"a": 1, "b": 2, "c": "3", "d": 4}\n{"a": 1.1, "b": 2, "c": 3, "e": {}}\n'
+                == '{"a":1,"b":2,"c":"3","d":4}\n{"a":1.1,"b":2,"c":3,"e":{}}\n'
             )
         exporter.finish_export()
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
@@ -152,11 +485,11 @@ def test_predefined_fields():
             ("CREATE TABLE IF NOT EXISTS bb (b NUMBER, d NUMBER, e OBJECT)",),
             (
                 'COPY INTO aa (a, b, c) FROM (SELECT $1:"a", $1:"b", $1:"c" FROM @~) FILE_FORMAT = '
-                "(TYPE = JSON) FILES = ('aa/INSTANCE_MS_1.jl')",
+                "(TYPE = JSON COMPRESSION = GZIP) FILES = ('aa/INSTANCE_MS_1.jl.gz')",
             ),
             (
                 'COPY INTO bb (b, d, e) FROM (SELECT $1:"b", $1:"d", $1:"e" FROM @~) FILE_FORMAT = '
-                "(TYPE = JSON) FILES = ('bb/INSTANCE_MS_1.jl')",
+                "(TYPE = JSON COMPRESSION = GZIP) FILES = ('bb/INSTANCE_MS_1.jl.gz')",
             ),
         ]
 
@@ -170,7 +503,7 @@ def test_predefined_fields():
                 ("CREATE TABLE IF NOT EXISTS table (a VARCHAR, b NUMBER)",),
                 (
                     'COPY INTO table (a, b) FROM (SELECT $1:"a", $1:"b" FROM @~) FILE_FORMAT = (TYPE '
-                    "= JSON) FILES = ('table/INSTANCE_MS_1.jl')",
+                    "= JSON COMPRESSION = GZIP) FILES = ('table/INSTANCE_MS_1.jl.gz')",
                 ),
             ],
         ),
@@ -179,8 +512,8 @@ def test_predefined_fields():
             [
                 ("CREATE TABLE IF NOT EXISTS table (a VARCHAR)",),
                 (
-                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                    "FILES = ('table/INSTANCE_MS_1.jl')",
+                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                    "FILES = ('table/INSTANCE_MS_1.jl.gz')",
                 ),
             ],
         ),
@@ -197,6 +530,95 @@ def test_ignore_unexpected_fields(ignore, expect_sqls):
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == expect_sqls
 
 
+def test_item_types():
+    @dataclass
+    class Item:
+        a: int
+        b: dict
+
+    with make_test_exporter("table") as exporter:
+        flat = {"a": 1, "b": "x", "c": None}
+        exporter.export_item(flat)
+        exporter.export_item({"a": 2, "b": {"nested": Item(1, {})}})
+        exporter.export_item(Item(3, {"c": [Item(4, {})]}))
+        assert read_table_buffer(exporter, "table") == (
+            '{"a":1,"b":"x","c":null}\n'
+            '{"a":2,"b":{"nested":{"a":1,"b":{}}}}\n'
+            '{"a":3,"b":{"c":[{"a":4,"b":{}}]}}\n'
+        )
+        assert flat == {"a": 1, "b": "x", "c": None}
+
+
+def test_value_subclasses():
+    class Color(str, Enum):
+        RED = "red"
+
+    with make_test_exporter("table") as exporter:
+        exporter.export_item(
+            {
+                "a": Color.RED,
+                "b": IntEnum("Size", "S M")(1),
+                "c": OrderedDict(),
+                "d": True,
+            }
+        )
+        assert exporter._recorded_coltypes == {
+            "table": {
+                "a": {"VARCHAR"},
+                "b": {"NUMBER"},
+                "c": {"OBJECT"},
+                "d": {"BOOLEAN"},
+            }
+        }
+        with pytest.raises(KeyError):
+            exporter.export_item({"a": (1, 2)})
+
+
+def test_serialize_item_override():
+    class Exporter(SnowflakeStageExporter):
+        def serialize_item(self, item_dict):
+            return orjson.dumps(
+                item_dict, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
+            )
+
+    with patch("snowflake.connector", MagicMock()), Exporter(
+        "user", "pass", "account", "table"
+    ) as exporter:
+        exporter.export_item({"b": "x", "a": 1})
+        assert read_table_buffer(exporter, "table") == '{"a":1,"b":"x"}\n'
+
+
+@pytest.mark.parametrize("table_path", ["{table}", "{item[table]}"])
+def test_export_items(table_path):
+    items = [{"table": "a", "n": n} for n in range(50)]
+    with make_test_exporter(table_path, max_file_size=200) as exporter:
+        exporter.export_items(iter(items), table="a")
+        exporter.export_items([], table="a")
+        exporter.finish_export()
+        assert exporter._exported_fpaths == {
+            "a": [f"a/INSTANCE_MS_{n}.jl.gz" for n in range(1, 6)]
+        }
+        assert exporter._recorded_coltypes == {
+            "a": {"table": {"VARCHAR"}, "n": {"NUMBER"}}
+        }
+
+
+@pytest.mark.parametrize(
+    "value, line",
+    [
+        (2 ** 64, b'{"a":18446744073709551616}\n'),
+        ("x\ud800", b'{"a":"x\\ud800"}\n'),
+    ],
+)
+def test_json_fallback(value, line):
+    with make_test_exporter("table") as exporter:
+        assert exporter.serialize_item({"a": value}) == line
+        exporter.export_item({"a": value})
+        assert exporter._recorded_coltypes == {
+            "table": {"a": {exporter.typemap[type(value)]}}
+        }
+
+
 @pytest.mark.parametrize("value", [object(), b"", 5j])
 def test_non_serializable(value):
     with pytest.raises(TypeError):
@@ -227,8 +649,8 @@ def test_dynamic_fields():
         ),
         (
             'COPY INTO table (a, b, c, e, f, g, h) FROM (SELECT $1:"a", $1:"b", $1:"c", $1:"e", '
-            '$1:"f", $1:"g", $1:"h" FROM @~) FILE_FORMAT = (TYPE = JSON) FILES = '
-            "('table/INSTANCE_MS_1.jl')",
+            '$1:"f", $1:"g", $1:"h" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) FILES = '
+            "('table/INSTANCE_MS_1.jl.gz')",
         ),
     ]
 
@@ -242,7 +664,7 @@ def test_dynamic_fields():
                 ("CREATE TABLE IF NOT EXISTS table (a VARIANT, b VARIANT, c ARRAY)",),
                 (
                     'COPY INTO table (a, b, c) FROM (SELECT $1:"a", $1:"b", $1:"c" FROM @~) '
-                    "FILE_FORMAT = (TYPE = JSON) FILES = ('table/INSTANCE_MS_1.jl')",
+                    "FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) FILES = ('table/INSTANCE_MS_1.jl.gz')",
                 ),
             ],
         ),
@@ -251,8 +673,8 @@ def test_dynamic_fields():
             [
                 ("CREATE TABLE IF NOT EXISTS table (c ARRAY)",),
                 (
-                    'COPY INTO table (c) FROM (SELECT $1:"c" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                    "FILES = ('table/INSTANCE_MS_1.jl')",
+                    'COPY INTO table (c) FROM (SELECT $1:"c" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                    "FILES = ('table/INSTANCE_MS_1.jl.gz')",
                 ),
             ],
         ),
@@ -266,6 +688,74 @@ def test_allow_varying_value_types(allow, expect_sqls):
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == expect_sqls
 
 
+def test_recorded_signatures():
+    with make_test_exporter("table") as exporter:
+        exporter.max_recorded_signatures = 2
+        exporter.export_item({"a": 1, "b": None})
+        exporter.export_item({"a": 2, "b": None})
+        assert exporter._recorded_signatures == {"table": {("a", "b", int, type(None))}}
+        exporter.export_item({"a": 3, "b": "x"})
+        exporter.export_item({"b": 4, "a": 5})
+        exporter.export_item({"b": 4, "a": 5})
+        # new combinations are still recorded once there are too many to remember
+        assert len(exporter._recorded_signatures["table"]) == 2
+        assert exporter._recorded_coltypes == {
+            "table": {"a": {"NUMBER"}, "b": {"VARCHAR", "NUMBER"}}
+        }
+
+
+def test_column_types_cache():
+    predefined = {"table": {"a": "VARCHAR"}}
+    with make_test_exporter(
+        "table",
+        predefined_column_types=predefined,
+        ignore_unexpected_fields=False,
+    ) as exporter:
+        exporter.export_item({"a": 1, "b": 2})
+        columns = exporter.get_column_types("table")
+        assert columns == {"a": "VARCHAR", "b": "NUMBER"}
+        exporter.export_item({"a": 2, "b": 3})
+        assert exporter.get_column_types("table") is columns
+        exporter.export_item({"a": 2, "b": 3, "c": True})
+        assert exporter.get_column_types("table") == {
+            "a": "VARCHAR",
+            "b": "NUMBER",
+            "c": "BOOLEAN",
+        }
+        exporter.export_item({"b": "3"})
+        assert exporter.get_column_types("table") == {"a": "VARCHAR", "c": "BOOLEAN"}
+    # predefined column types aren't modified
+    assert predefined == {"table": {"a": "VARCHAR"}}
+
+
+def test_copy_columns_sql_cache():
+    def cached_entry():
+        return exporter._copy_columns_cache["table"]
+
+    with make_test_exporter("table", allow_varying_value_types=True) as exporter:
+        exporter.export_item({"a b": 1, 'c"': 2})
+        cols, select = exporter._copy_columns_sql("table")
+        assert (cols, select) == ("a_b, c", '$1:"a b", $1:"c"""')
+        entry = cached_entry()
+        # same cached strings while the schema doesn't change
+        exporter.export_item({"a b": 3, 'c"': 4})
+        for _ in range(2):
+            cols2, select2 = exporter._copy_columns_sql("table")
+            assert cols2 is cols and select2 is select
+        assert cached_entry() is entry
+        # rebuilt once a new field is recorded
+        exporter.export_item({"d": 1})
+        cols, select = exporter._copy_columns_sql("table")
+        assert (cols, select) == ("a_b, c, d", '$1:"a b", $1:"c""", $1:"d"')
+        assert cached_entry() is not entry
+        entry = cached_entry()
+        # ... or a new value type of a known field
+        exporter.export_item({"d": "x"})
+        assert exporter._copy_columns_sql("table") == (cols, select)
+        assert cached_entry() is not entry
+        assert cached_entry()[0] == {"a b": "NUMBER", 'c"': "NUMBER", "d": "VARIANT"}
+
+
 def test_all_fields_skipped():
     with make_test_exporter("table") as exporter:
         exporter.export_item({"a": 1})
@@ -276,6 +766,27 @@ def test_all_fields_skipped():
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == []
 
 
+def test_stage_path_quoting():
+    with make_test_exporter(
+        "table", patch_put=False, stage_path="it's/{batch_n}.jl"
+    ) as exporter:
+        cursor = exporter.conn.cursor()
+        cursor.execute.return_value.fetchone.return_value = (None, "1.jl.gz")
+        exporter.export_item({"a": 1})
+        exporter.finish_export()
+        assert mock_calls_get_sql(cursor.execute.call_args_list) == [
+            (
+                "PUT 'file://1.jl.gz' '@~/it\\'s' AUTO_COMPRESS = FALSE SOURCE_COMPRESSION = "
+                "GZIP",
+            ),
+            ("CREATE TABLE IF NOT EXISTS table (a NUMBER)",),
+            (
+                'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON '
+                "COMPRESSION = GZIP) FILES = ('it\\'s/1.jl.gz')",
+            ),
+        ]
+
+
 def test_stage_path():
     with make_test_exporter(
         "table", stage="@x", stage_path="AA/BB/cc/{table_path}/{instance_ms}/{batch_n}"
@@ -283,8 +794,8 @@ def test_stage_path():
         exporter.export_item({"a": 1})
         exporter.finish_export()
         assert mock_calls_get_sql(exporter.conn.cursor().mock_calls)[-1] == (
-            'COPY INTO table (a) FROM (SELECT $1:"a" FROM @x) FILE_FORMAT = (TYPE = JSON) '
-            "FILES = ('AA/BB/cc/table/INSTANCE_MS/1')",
+            'COPY INTO table (a) FROM (SELECT $1:"a" FROM @x) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+            "FILES = ('AA/BB/cc/table/INSTANCE_MS/1.gz')",
         )
 
 
@@ -296,15 +807,15 @@ def test_stage_path():
             [
                 ("CREATE TABLE IF NOT EXISTS table (a NUMBER)",),
                 (
-                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                    "FILES = ('table/INSTANCE_MS_1.jl')",
+                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                    "FILES = ('table/INSTANCE_MS_1.jl.gz')",
                 ),
-                ("REMOVE %s", [("@~/table/INSTANCE_MS_1.jl",)]),
+                ("REMOVE %s", ("@~/table/INSTANCE_MS_1.jl.gz",)),
                 (
-                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                    "FILES = ('table/INSTANCE_MS_2.jl')",
+                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                    "FILES = ('table/INSTANCE_MS_2.jl.gz')",
                 ),
-                ("REMOVE %s", [("@~/table/INSTANCE_MS_2.jl",)]),
+                ("REMOVE %s", ("@~/table/INSTANCE_MS_2.jl.gz",)),
             ],
         ),
         (
@@ -312,12 +823,15 @@ def test_stage_path():
             [
                 ("CREATE TABLE IF NOT EXISTS table (a NUMBER)",),
                 (
-                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON) '
-                    "FILES = ('table/INSTANCE_MS_1.jl', 'table/INSTANCE_MS_2.jl')",
+                    'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) '
+                    "FILES = ('table/INSTANCE_MS_1.jl.gz', 'table/INSTANCE_MS_2.jl.gz')",
                 ),
                 (
-                    "REMOVE %s",
-                    [("@~/table/INSTANCE_MS_1.jl",), ("@~/table/INSTANCE_MS_2.jl",)],
+                    "REMOVE %s PATTERN = %s",
+                    (
+                        "@~/table/",
+                        r"^table/(INSTANCE_MS_1\.jl\.gz|INSTANCE_MS_2\.jl\.gz)$",
+                    ),
                 ),
             ],
         ),
@@ -344,6 +858,44 @@ def test_on_flush_or_finish(flush_or_finish, expect_sqls):
             assert exporter.conn.cursor().mock_calls == calls_pre_finish
 
 
+@pytest.mark.parametrize("max_upload_workers", [1, 4])
+def test_clear_stage_on_flush_all(max_upload_workers):
+    with make_test_exporter(
+        "{table}",
+        stage_path="{table_path}_{batch_n}.jl",
+        clear_stage_on="flush",
+        max_upload_workers=max_upload_workers,
+    ) as exporter:
+        for table in ("a", "b"):
+            exporter.export_item({"a": 1}, table=table)
+        exporter.flush_all_table_buffers()
+        assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
+            ("REMOVE %s PATTERN = %s", ("@~/", r"^(a_1\.jl\.gz|b_1\.jl\.gz)$")),
+        ]
+
+
+def test_populate_in_chunks():
+    with make_test_exporter("table") as exporter:
+        exporter.max_files_per_copy = 2
+        for _ in range(3):
+            exporter.export_item({"a": 1})
+            exporter.flush_all_table_buffers()
+        exporter.finish_export()
+        exporter.populate_all_tables()  # nothing new to copy
+        assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
+            ("CREATE TABLE IF NOT EXISTS table (a NUMBER)",),
+            (
+                'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON '
+                "COMPRESSION = GZIP) FILES = ('table/INSTANCE_MS_1.jl.gz', "
+                "'table/INSTANCE_MS_2.jl.gz')",
+            ),
+            (
+                'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = JSON '
+                "COMPRESSION = GZIP) FILES = ('table/INSTANCE_MS_3.jl.gz')",
+            ),
+        ]
+
+
 def test_new_field_after_table_created():
     with make_test_exporter(
         "table", create_tables_on="flush", populate_tables_on="finish"
@@ -356,7 +908,7 @@ def test_new_field_after_table_created():
             ("CREATE TABLE IF NOT EXISTS table (a NUMBER)",),
             (
                 'COPY INTO table (a) FROM (SELECT $1:"a" FROM @~) FILE_FORMAT = (TYPE = '
-                "JSON) FILES = ('table/INSTANCE_MS_1.jl', 'table/INSTANCE_MS_2.jl')",
+                "JSON COMPRESSION = GZIP) FILES = ('table/INSTANCE_MS_1.jl.gz', 'table/INSTANCE_MS_2.jl.gz')",
             ),
         ]
 
@@ -382,8 +934,8 @@ def test_messy_identifiers():
         exporter.export_item({"name": "Jack", 'sZZZal\'a""ry': "zzzzz"})
         exporter.export_item({'na ;M.""e': [], "9salary": 1.1})
         assert read_table_buffer(exporter, "DEMO__DB.PUBLIC.Z_Z") == (
-            '{".": 100}\n{"..": "100"}\n{"salary": 100}\n{"salary  ": "2"}\n'
-            '{"name": "Jack", "sZZZal\'a\\"\\"ry": "zzzzz"}\n{"na ;M.\\"\\"e": [], "9salary": 1.1}\n'
+            '{".":100}\n{"..":"100"}\n{"salary":100}\n{"salary  ":"2"}\n'
+            '{"name":"Jack","sZZZal\'a\\"\\"ry":"zzzzz"}\n{"na ;M.\\"\\"e":[],"9salary":1.1}\n'
         )
         exporter.finish_export()
     assert mock_calls_get_sql(exporter.conn.cursor().mock_calls) == [
@@ -396,7 +948,7 @@ def test_messy_identifiers():
             "COPY INTO DEMO__DB.PUBLIC.Z_Z (_empty_cdb4ee, _empty_5ec1f7, salary, "
             'salary, name, sZZZal_a_ry, na_M_e, _9salary) FROM (SELECT $1:".", $1:"..", '
             '$1:"salary", $1:"salary  ", $1:"name", $1:"sZZZal\'a""""ry", $1:"na '
-            ';M.""""e", $1:"9salary" FROM @~) FILE_FORMAT = (TYPE = JSON) FILES = '
-            "('DEMO__DB.PUBLIC.Z_Z/INSTANCE_MS_1.jl')",
+            ';M.""""e", $1:"9salary" FROM @~) FILE_FORMAT = (TYPE = JSON COMPRESSION = GZIP) FILES = '
+            "('DEMO__DB.PUBLIC.Z_Z/INSTANCE_MS_1.jl.gz')",
         ),
     ]
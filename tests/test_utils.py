@@ -1,6 +1,16 @@
+import re
+
 import pytest
 
-from snowflake_stage_exporter.utils import chunk, normalize_identifier
+from snowflake_stage_exporter.utils import (
+    chunk,
+    escape_regex,
+    normalize_identifier,
+    quote_string,
+    template_field_names,
+    template_fields,
+    template_item_keys,
+)
 
 
 @pytest.mark.parametrize(
@@ -34,9 +44,79 @@ def test_chunk(iterable, n, result):
         ("ABc", "ABc"),
         ("  AB;c =+ ", "AB_c"),
         ("  AB   c", "AB_c"),
+        ("a\tb\nc", "a_b_c"),
+        ("٣a", "_٣a"),
+        ("ſ x", "ſ_x"),
     ],
 )
 def test_normalize_identifier(value, result):
     ret = normalize_identifier(value)
     assert ret == result
     assert normalize_identifier(ret) == ret  # check idempotency
+
+
+@pytest.mark.parametrize(
+    "template, result",
+    [
+        ("table", ()),
+        ("{table}", ("table",)),
+        ("DB.{b}_{a}_{b!r:>5}", ("a", "b")),
+        ("{spider.name}_{item[entity_type]}", ("item", "spider")),
+        ("{{escaped}}_{item}", ("item",)),
+    ],
+)
+def test_template_fields(template, result):
+    assert template_fields(template) == result
+
+
+@pytest.mark.parametrize(
+    "template, result",
+    [
+        ("table", ()),
+        ("DB.{b}_{a}_{b!r:>5}", ("a", "b")),
+        ("{spider.name}_{item[a]}_{{escaped}}", ("item[a]", "spider.name")),
+    ],
+)
+def test_template_field_names(template, result):
+    assert template_field_names(template) == result
+
+
+@pytest.mark.parametrize(
+    "template, result",
+    [
+        ("{table}", ()),
+        ("{a}_{item[b]}_{item[a]!r:>5}_{item[b]}", ("a", "b")),
+        ("{item[0]}_{item[x y]}", (0, "x y")),
+        ("{item}", None),
+        ("{item.a}", None),
+        ("{item[a]}_{item[a][b]}", None),
+    ],
+)
+def test_template_item_keys(template, result):
+    assert template_item_keys(template) == result
+
+
+@pytest.mark.parametrize(
+    "value, result",
+    [
+        ("", "''"),
+        ("a/b.jl.gz", "'a/b.jl.gz'"),
+        ("it's", "'it\\'s'"),
+        ("a\\'b", "'a\\\\\\'b'"),
+    ],
+)
+def test_quote_string(value, result):
+    assert quote_string(value) == result
+
+
+@pytest.mark.parametrize(
+    "value, result",
+    [
+        ("abc_1-2", "abc_1-2"),
+        ("1_2.jl.gz", r"1_2\.jl\.gz"),
+        ("a(b)|[c]{d}*+?^$\\", r"a\(b\)\|\[c\]\{d\}\*\+\?\^\$\\"),
+    ],
+)
+def test_escape_regex(value, result):
+    assert re.fullmatch(escape_regex(value), value)
+    assert escape_regex(value) == result